@@ -5,79 +5,249 @@ Parses contents of release-versions.yaml file and copies release candidates to g
 """
 
 import sys
+import json
 import yaml
 import subprocess
 import os
+import copy
+import mmap
+import asyncio
+import tempfile
+import collections
+
+try:
+  from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+  from yaml import SafeLoader as _YamlLoader
 
 _SBOM_TAG = "sbom"
 _COS_GPU_INSTALLER_STAGING_NAME = "cos-gpu-installer"
+_GCR_PREFIX = "gcr.io/"
+_GCR_SUFFIX = "gcr.io"
+_REQUIRED_CONFIG_KEYS = frozenset(("staging_container_name", "release_container_name", "build_commit", "release_tags"))
+
+# Number of concurrent gcloud add-tag invocations, overridable via $GCLOUD_PARALLELISM.
+_PARALLELISM_ENV = "GCLOUD_PARALLELISM"
+_DEFAULT_PARALLELISM = 16
+_ADD_TAG_ATTEMPTS = 3
+_ADD_TAG_BACKOFF_SECONDS = 2
+
+# Skip gcloud's periodic component update check, which otherwise adds startup
+# latency to every add-tag invocation.
+_GCLOUD_ENV_OVERRIDES = {"CLOUDSDK_COMPONENT_MANAGER_DISABLE_UPDATE_CHECK": "1"}
+
+_RELEASE_CONFIG_PATH = "release/release-versions.yaml"
+_JSON_CACHE_SUFFIX = ".json"
+_WRITE_JSON_CACHE_FLAG = "--write-json-cache"
+
+# Parsed YAML files keyed by path, each stored as (mtime, size, parsed object).
+_YAML_CACHE_MAX_ENTRIES = 100
+_yaml_cache = collections.OrderedDict()
 
 def validate_config(release_config):
+  if not isinstance(release_config, list):
+    raise ValueError("release config must be a list of entries, got {!r}".format(release_config))
   for release_container in release_config:
-    for key in ["staging_container_name", "release_container_name", "build_commit", "release_tags"]:
-      assert key in release_container, "missing {} in entry {}".format(key, release_container)
+    if not isinstance(release_container, dict):
+      raise ValueError("release config entry must be a mapping, got {!r}".format(release_container))
+    missing_keys = _REQUIRED_CONFIG_KEYS - release_container.keys()
+    if missing_keys:
+      raise ValueError("missing {} in entry {}".format(", ".join(sorted(missing_keys)), release_container))
 
 def validate_src_gcr_path(path):
   # path format: gcr.io/cos-infra-prod
-  return len(path) > len("gcr.io/") and path[:len("gcr.io/")] == "gcr.io/"
+  return len(path) > len(_GCR_PREFIX) and path.startswith(_GCR_PREFIX)
 
 def validate_dst_gcr_path(path):
   # path format: us-docker.pkg.dev/cos-cloud/us.gcr.io
   path = path.split('/')
-  return len(path) == 3 and len(path[0]) > len("docker.pkg.dev/") and len(path[1]) != 0 and path[2][-len("gcr.io"):] == "gcr.io"
-
-def copy_container_image(src_bucket, dst_bucket, staging_container_name, release_container_name, build_tag, release_tags):
-  assert validate_src_gcr_path(src_bucket), "cannot use address {}, only gcr.io/ addresses are supported".format(src_bucket)
-  assert validate_dst_gcr_path(dst_bucket), "cannot use address {}, only <location>-docker.pkg.dev/<project-name>/<location(optional)>gcr.io/ addresses are supported".format(dst_bucket)
+  return len(path) == 3 and len(path[0]) > len("docker.pkg.dev/") and len(path[1]) != 0 and path[2].endswith(_GCR_SUFFIX)
 
-  src_path = os.path.join(src_bucket, staging_container_name)
-  dst_path = os.path.join(dst_bucket, release_container_name)
+def source_image_ref(src_bucket, staging_container_name, build_tag):
+  src_bucket = src_bucket.rstrip('/')
+  if not validate_src_gcr_path(src_bucket):
+    raise ValueError("cannot use address {}, only gcr.io/ addresses are supported".format(src_bucket))
+  return f"{src_bucket}/{staging_container_name}:{build_tag}"
 
-  for release_tag in release_tags:
-    subprocess.run(["gcloud", "container", "images", "add-tag", src_path + ":" + build_tag, dst_path + ":" + release_tag, "-q"])
+# Returns the (source image reference, destination image references) request for copying a release container.
+def container_image_tag_request(src_bucket, dst_bucket, staging_container_name, release_container_name, build_tag, release_tags):
+  src_ref = source_image_ref(src_bucket, staging_container_name, build_tag)
+  if not validate_dst_gcr_path(dst_bucket):
+    raise ValueError("cannot use address {}, only <location>-docker.pkg.dev/<project-name>/<location(optional)>gcr.io/ addresses are supported".format(dst_bucket))
 
-# Add tag for generating and uploading SBOM for cos-gpu-installer via louhi workflow.
-def add_tag_for_sbom(src_bucket, staging_container_name, release_container_name, build_tag):
-  if staging_container_name != _COS_GPU_INSTALLER_STAGING_NAME:
-    return
-
-  assert validate_src_gcr_path(src_bucket), "cannot use address {}, only gcr.io/ addresses are supported".format(src_bucket)
-
-  src_path = os.path.join(src_bucket, staging_container_name)
-  dst_path = os.path.join(src_bucket, release_container_name)
+  dst_path = f"{dst_bucket}/{release_container_name}"
 
-  subprocess.run(["gcloud", "container", "images", "add-tag", src_path + ":" + build_tag, dst_path + ":" + _SBOM_TAG, "-q"])
+  return (src_ref, [f"{dst_path}:{release_tag}" for release_tag in release_tags])
 
-def verify_and_release(src_bucket, dst_buckets, release):
-  with open('release/release-versions.yaml', 'r') as file:
+# Returns the request adding the tag used to generate and upload the SBOM for cos-gpu-installer
+# via louhi workflow, or None for other containers.
+def sbom_tag_request(src_bucket, staging_container_name, release_container_name, build_tag):
+  if staging_container_name != _COS_GPU_INSTALLER_STAGING_NAME:
+    return None
+
+  src_ref = source_image_ref(src_bucket, staging_container_name, build_tag)
+  dst_ref = f"{src_bucket.rstrip('/')}/{release_container_name}:{_SBOM_TAG}"
+
+  return (src_ref, [dst_ref])
+
+# gcloud add-tag accepts any number of destination images, so all tags of a
+# source image in one destination are applied with a single invocation.
+# The semaphore is held per attempt so a call waiting to retry does not block other calls.
+async def add_tag(src_ref, dst_refs, semaphore):
+  for attempt in range(_ADD_TAG_ATTEMPTS):
+    async with semaphore:
+      process = await asyncio.create_subprocess_exec("gcloud", "container", "images", "add-tag", src_ref, *dst_refs, "-q",
+                                                     stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                                     env=dict(os.environ, **_GCLOUD_ENV_OVERRIDES))
+      _, stderr = await process.communicate()
+    if process.returncode == 0:
+      return
+    if attempt + 1 == _ADD_TAG_ATTEMPTS:
+      raise Exception("failed to tag {} as {}: {}".format(src_ref, " ".join(dst_refs), stderr.decode().strip()))
+    await asyncio.sleep(_ADD_TAG_BACKOFF_SECONDS * 2 ** attempt)
+
+# Drops destination references that an earlier request already tags from the
+# same source. Tags are applied concurrently, so a destination reference
+# requested from two different sources is rejected rather than racing.
+def remove_duplicate_tags(tag_requests):
+  planned = {}
+  unique_requests = []
+  for src_ref, dst_refs in tag_requests:
+    unique_dst_refs = []
+    for dst_ref in dst_refs:
+      if dst_ref not in planned:
+        planned[dst_ref] = src_ref
+        unique_dst_refs.append(dst_ref)
+      elif planned[dst_ref] != src_ref:
+        raise ValueError("{} is requested from both {} and {}".format(dst_ref, planned[dst_ref], src_ref))
+    unique_requests.append((src_ref, unique_dst_refs))
+  return unique_requests
+
+def get_parallelism():
+  value = os.environ.get(_PARALLELISM_ENV, str(_DEFAULT_PARALLELISM))
+  try:
+    parallelism = int(value)
+  except ValueError:
+    parallelism = 0
+  if parallelism < 1:
+    raise ValueError("${} must be a positive integer, got {!r}".format(_PARALLELISM_ENV, value))
+  return parallelism
+
+async def add_tags_async(tag_requests):
+  semaphore = asyncio.Semaphore(get_parallelism())
+  # Let in-flight calls finish, then report every failure together.
+  results = await asyncio.gather(*[add_tag(src_ref, dst_refs, semaphore) for src_ref, dst_refs in tag_requests if dst_refs],
+                                 return_exceptions=True)
+  failures = [str(result) for result in results if isinstance(result, Exception)]
+  if failures:
+    raise Exception("{} of {} add-tag calls failed:\n{}".format(len(failures), len(results), "\n".join(failures)))
+
+def add_tags(tag_requests):
+  asyncio.run(add_tags_async(tag_requests))
+
+# Returns a copy of the parsed YAML file, reparsing only when its mtime or size changed.
+def load_yaml_cached(path):
+  stat = os.stat(path)
+  cached = _yaml_cache.get(path)
+  if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+    _yaml_cache.move_to_end(path)
+    return copy.deepcopy(cached[2])
+
+  if stat.st_size == 0:
+    parsed = None
+  else:
+    # Let the parser read straight from the mapped file rather than through a Python file object.
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+      parsed = yaml.load(mapped, Loader=_YamlLoader)
+  _yaml_cache[path] = (stat.st_mtime_ns, stat.st_size, parsed)
+  _yaml_cache.move_to_end(path)
+  if len(_yaml_cache) > _YAML_CACHE_MAX_ENTRIES:
+    _yaml_cache.popitem(last=False)
+  return copy.deepcopy(parsed)
+
+# The JSON sidecar is only trusted if it belongs to the current user and nobody else can write to it.
+def is_trusted_json_cache(stat):
+  return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+# Loads the release config. Release runs use the JSON sidecar when it is trusted
+# and was written from a YAML file with exactly the current mtime and size.
+# --verify runs always parse and validate the YAML itself and, if
+# write_json_cache is set, refresh the sidecar so the following release run can
+# skip the parse.
+def load_release_config(path, release, write_json_cache):
+  json_path = path + _JSON_CACHE_SUFFIX
+  yaml_stat = os.stat(path)
+  yaml_key = [yaml_stat.st_mtime_ns, yaml_stat.st_size]
+  if release:
     try:
-      release_config = yaml.safe_load(file)
-      validate_config(release_config)
-
-      if release:
-        dst_buckets = dst_buckets.split('^')
-        for release_container in release_config:
-          staging_container_name = release_container["staging_container_name"]
-          release_container_name = release_container["release_container_name"]
-          build_tag = release_container["build_commit"]
-          release_tags = release_container["release_tags"]
-          for dst_bucket in dst_buckets:
-            copy_container_image(src_bucket, dst_bucket, staging_container_name, release_container_name, build_tag, release_tags)
-          add_tag_for_sbom(src_bucket, staging_container_name, release_container_name, build_tag)
-
-    except yaml.YAMLError as ex:
-      raise Exception("Invalid YAML config: %s" % str(ex))
+      if is_trusted_json_cache(os.stat(json_path)):
+        with open(json_path, 'r') as file:
+          cache = json.load(file)
+        if isinstance(cache, dict) and cache.get("yaml_key") == yaml_key:
+          release_config = cache.get("release_config")
+          validate_config(release_config)
+          return release_config
+    except (OSError, ValueError):
+      pass
+
+  release_config = load_yaml_cached(path)
+  validate_config(release_config)
+  if write_json_cache:
+    write_json_cache_file(json_path, {"yaml_key": yaml_key, "release_config": release_config})
+  return release_config
+
+# Atomically replaces the JSON sidecar. The sidecar is only an optimization, so
+# configs that JSON cannot represent, such as unquoted YAML dates, and write
+# failures such as a read-only checkout only print a warning.
+def write_json_cache_file(json_path, cache):
+  tmp_path = None
+  try:
+    # mkstemp creates a new 0600 file with O_EXCL, so a planted file or symlink is never followed.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(json_path) or ".", prefix=os.path.basename(json_path) + ".")
+    with os.fdopen(fd, 'w') as file:
+      json.dump(cache, file)
+    os.replace(tmp_path, json_path)
+    tmp_path = None
+  except (OSError, TypeError) as ex:
+    print("not writing {}: {}".format(json_path, ex), file=sys.stderr)
+  finally:
+    if tmp_path and os.path.exists(tmp_path):
+      os.remove(tmp_path)
+
+def verify_and_release(src_bucket, dst_buckets, release, write_json_cache=False):
+  try:
+    release_config = load_release_config(_RELEASE_CONFIG_PATH, release, write_json_cache)
+
+    if release:
+      dst_buckets = dst_buckets.split('^')
+      tag_requests = []
+      for release_container in release_config:
+        staging_container_name = release_container["staging_container_name"]
+        release_container_name = release_container["release_container_name"]
+        build_tag = release_container["build_commit"]
+        release_tags = release_container["release_tags"]
+        for dst_bucket in dst_buckets:
+          tag_requests.append(container_image_tag_request(src_bucket, dst_bucket, staging_container_name, release_container_name, build_tag, release_tags))
+        sbom_request = sbom_tag_request(src_bucket, staging_container_name, release_container_name, build_tag)
+        if sbom_request:
+          tag_requests.append(sbom_request)
+      add_tags(remove_duplicate_tags(tag_requests))
+
+  except yaml.YAMLError as ex:
+    raise Exception("Invalid YAML config: %s" % str(ex))
 
 def main():
-  if len(sys.argv) == 2 and sys.argv[1] == "--verify":
-    verify_and_release("", "", False)
-  elif len(sys.argv) == 3:
-    src_bucket = sys.argv[1]
-    dst_buckets = sys.argv[2]
-
-    verify_and_release(src_bucket, dst_buckets, True)
+  args = [arg for arg in sys.argv[1:] if arg != _WRITE_JSON_CACHE_FLAG]
+  write_json_cache = len(args) != len(sys.argv) - 1
+  if len(args) == 1 and args[0] == "--verify":
+    verify_and_release("", "", False, write_json_cache)
+  elif len(args) == 2:
+    src_bucket = args[0]
+    dst_buckets = args[1]
+
+    verify_and_release(src_bucket, dst_buckets, True, write_json_cache)
   else:
-    sys.exit("sample use: ./release_script <source_gcr_path> <destination_gcr_paths> \n \
+    sys.exit("sample use: ./release_script [--write-json-cache] <source_gcr_path> <destination_gcr_paths> \n \
               example use: ./release_script gcr.io/cos-infra-prod us-docker.pkg.dev/cos-cloud/us.gcr.io^europe-docker.pkg.dev/cos-cloud/eu.gcr.io")
 
 if __name__ == '__main__':
@@ -0,0 +1,279 @@
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import yaml
+
+import release
+
+_CONFIG = """- staging_container_name: "toolbox"
+  release_container_name: "toolbox"
+  build_commit: "3e0ddb45b4c2ee772555472096bc4efe7c4248d6"
+  release_tags:
+    - "latest"
+"""
+
+class TestReleaseConfigCache(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, "release-versions.yaml")
+    self.json_path = self.path + ".json"
+    self.write_config(_CONFIG)
+    release._yaml_cache.clear()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def write_config(self, contents):
+    with open(self.path, 'w') as file:
+      file.write(contents)
+
+  def test_verify_writes_sidecar_that_release_reuses(self):
+    expected = yaml.safe_load(_CONFIG)
+    self.assertEqual(release.load_release_config(self.path, False, True), expected)
+    self.assertEqual(os.stat(self.json_path).st_mode & 0o777, 0o600)
+    with mock.patch.object(release, "load_yaml_cached", side_effect=AssertionError("YAML was parsed")):
+      self.assertEqual(release.load_release_config(self.path, True, False), expected)
+
+  def test_verify_ignores_sidecar(self):
+    release.load_release_config(self.path, False, True)
+    json_stat = os.stat(self.json_path)
+    self.write_config("- [invalid")
+    os.utime(self.path, ns=(json_stat.st_atime_ns, json_stat.st_mtime_ns))
+    with self.assertRaises(yaml.YAMLError):
+      release.load_release_config(self.path, False, False)
+
+  def test_release_ignores_sidecar_for_replaced_yaml(self):
+    release.load_release_config(self.path, False, True)
+    yaml_stat = os.stat(self.path)
+    # Same size and an older, preserved mtime, as left behind by cp -p or rsync -a.
+    self.write_config(_CONFIG.replace("latest", "v2.0.0"))
+    os.utime(self.path, ns=(yaml_stat.st_atime_ns, yaml_stat.st_mtime_ns - 10**9))
+    self.assertEqual(release.load_release_config(self.path, True, False)[0]["release_tags"], ["v2.0.0"])
+
+  def test_release_ignores_sidecar_for_resized_yaml(self):
+    release.load_release_config(self.path, False, True)
+    yaml_stat = os.stat(self.path)
+    self.write_config(_CONFIG.replace("latest", "v2"))
+    os.utime(self.path, ns=(yaml_stat.st_atime_ns, yaml_stat.st_mtime_ns))
+    self.assertEqual(release.load_release_config(self.path, True, False)[0]["release_tags"], ["v2"])
+
+  def test_release_ignores_untrusted_sidecar(self):
+    release.load_release_config(self.path, False, True)
+    os.chmod(self.json_path, 0o666)
+    with mock.patch.object(release, "load_yaml_cached", wraps=release.load_yaml_cached) as load_yaml:
+      release.load_release_config(self.path, True, False)
+    load_yaml.assert_called_once_with(self.path)
+
+  def test_release_falls_back_to_yaml_for_malformed_sidecar(self):
+    release.load_release_config(self.path, False, True)
+    with open(self.json_path) as file:
+      cache = json.load(file)
+    for release_config in [{"a": 1}, ["toolbox"], None]:
+      cache["release_config"] = release_config
+      with open(self.json_path, 'w') as file:
+        json.dump(cache, file)
+      self.assertEqual(release.load_release_config(self.path, True, False), yaml.safe_load(_CONFIG))
+
+  def test_unserializable_config_is_not_cached(self):
+    release.load_release_config(self.path, False, True)
+    self.write_config(_CONFIG + "  release_date: 2023-08-15\n")
+    release_config = release.load_release_config(self.path, False, True)
+    self.assertEqual(str(release_config[0]["release_date"]), "2023-08-15")
+    self.assertEqual(sorted(os.listdir(self.tmpdir)), ["release-versions.yaml", "release-versions.yaml.json"])
+    with mock.patch.object(release, "load_yaml_cached", wraps=release.load_yaml_cached) as load_yaml:
+      release.load_release_config(self.path, True, False)
+    load_yaml.assert_called_once_with(self.path)
+
+  def test_unwritable_sidecar_is_skipped(self):
+    with mock.patch.object(release.tempfile, "mkstemp", side_effect=PermissionError("read-only")):
+      self.assertEqual(release.load_release_config(self.path, False, True), yaml.safe_load(_CONFIG))
+    self.assertEqual(sorted(os.listdir(self.tmpdir)), ["release-versions.yaml"])
+
+  def test_failed_replace_removes_tmp_file(self):
+    with mock.patch.object(release.os, "replace", side_effect=OSError("busy")):
+      release.load_release_config(self.path, False, True)
+    self.assertEqual(sorted(os.listdir(self.tmpdir)), ["release-versions.yaml"])
+
+  def test_planted_symlink_is_not_followed(self):
+    target = os.path.join(self.tmpdir, "target")
+    os.symlink(target, self.json_path + ".tmp")
+    release.load_release_config(self.path, False, True)
+    self.assertFalse(os.path.exists(target))
+    self.assertEqual(os.stat(self.json_path).st_mode & 0o777, 0o600)
+
+class TestParallelism(unittest.TestCase):
+
+  def test_default(self):
+    with mock.patch.dict(os.environ, clear=True):
+      self.assertEqual(release.get_parallelism(), release._DEFAULT_PARALLELISM)
+
+  def test_override(self):
+    with mock.patch.dict(os.environ, {release._PARALLELISM_ENV: "4"}):
+      self.assertEqual(release.get_parallelism(), 4)
+
+  def test_rejects_invalid_values(self):
+    for value in ["0", "-1", "four"]:
+      with mock.patch.dict(os.environ, {release._PARALLELISM_ENV: value}):
+        with self.assertRaises(ValueError):
+          release.get_parallelism()
+
+class TestValidateConfig(unittest.TestCase):
+
+  def test_accepts_valid_config(self):
+    release.validate_config(yaml.safe_load(_CONFIG))
+
+  def test_rejects_missing_keys(self):
+    with self.assertRaisesRegex(ValueError, "missing release_container_name, release_tags"):
+      release.validate_config([{"staging_container_name": "toolbox", "build_commit": "abc"}])
+
+  def test_rejects_malformed_config(self):
+    for release_config in [None, {"a": 1}, "toolbox", ["toolbox"], [None]]:
+      with self.assertRaises(ValueError):
+        release.validate_config(release_config)
+
+class TestTagRequests(unittest.TestCase):
+
+  def test_container_image_tag_request(self):
+    self.assertEqual(
+        release.container_image_tag_request("gcr.io/cos-infra-prod", "us-docker.pkg.dev/cos-cloud/us.gcr.io",
+                                            "cos-gpu-installer-v1", "cos-gpu-installer", "abc", ["latest", "v1"]),
+        ("gcr.io/cos-infra-prod/cos-gpu-installer-v1:abc",
+         ["us-docker.pkg.dev/cos-cloud/us.gcr.io/cos-gpu-installer:latest",
+          "us-docker.pkg.dev/cos-cloud/us.gcr.io/cos-gpu-installer:v1"]))
+
+  def test_trailing_slash_in_source_bucket(self):
+    src_ref, _ = release.container_image_tag_request("gcr.io/cos-infra-prod/", "us-docker.pkg.dev/cos-cloud/us.gcr.io",
+                                                     "toolbox", "toolbox", "abc", ["latest"])
+    self.assertEqual(src_ref, "gcr.io/cos-infra-prod/toolbox:abc")
+    self.assertEqual(release.sbom_tag_request("gcr.io/cos-infra-prod/", "cos-gpu-installer", "cos-gpu-installer", "abc"),
+                     ("gcr.io/cos-infra-prod/cos-gpu-installer:abc", ["gcr.io/cos-infra-prod/cos-gpu-installer:sbom"]))
+
+  def test_sbom_tag_request_only_for_gpu_installer(self):
+    self.assertIsNone(release.sbom_tag_request("gcr.io/cos-infra-prod", "toolbox", "toolbox", "abc"))
+
+  def test_rejects_invalid_buckets(self):
+    with self.assertRaises(ValueError):
+      release.container_image_tag_request("docker.io/cos", "us-docker.pkg.dev/cos-cloud/us.gcr.io", "toolbox", "toolbox", "abc", [])
+    with self.assertRaises(ValueError):
+      release.container_image_tag_request("gcr.io/", "us-docker.pkg.dev/cos-cloud/us.gcr.io", "toolbox", "toolbox", "abc", [])
+    with self.assertRaises(ValueError):
+      release.container_image_tag_request("gcr.io/cos-infra-prod", "gcr.io/cos-cloud", "toolbox", "toolbox", "abc", [])
+
+class TestRemoveDuplicateTags(unittest.TestCase):
+
+  def test_drops_repeated_destinations(self):
+    tag_requests = [("src:1", ["dst:a", "dst:b", "dst:a"]), ("src:1", ["dst:b"]), ("src:1", ["dst:c"])]
+    self.assertEqual(release.remove_duplicate_tags(tag_requests),
+                     [("src:1", ["dst:a", "dst:b"]), ("src:1", []), ("src:1", ["dst:c"])])
+
+  def test_rejects_destination_from_two_sources(self):
+    tag_requests = [("src-v1:1", ["dst:latest"]), ("src:2", ["dst:v2", "dst:latest"])]
+    with self.assertRaisesRegex(ValueError, "dst:latest is requested from both src-v1:1 and src:2"):
+      release.remove_duplicate_tags(tag_requests)
+
+class FakeProcess:
+
+  def __init__(self, returncode, stderr=b"", delay=0):
+    self.returncode = returncode
+    self.stderr = stderr
+    self.delay = delay
+
+  async def communicate(self):
+    if self.delay:
+      future = asyncio.get_running_loop().create_future()
+      asyncio.get_running_loop().call_later(self.delay, future.set_result, None)
+      await future
+    return None, self.stderr
+
+class TestAddTags(unittest.TestCase):
+
+  def setUp(self):
+    self.calls = []
+    self.returncodes = {}
+    self.delays = {}
+    exec_patch = mock.patch.object(release.asyncio, "create_subprocess_exec", side_effect=self.fake_exec)
+    self.sleep = mock.AsyncMock()
+    sleep_patch = mock.patch.object(release.asyncio, "sleep", self.sleep)
+    exec_patch.start()
+    sleep_patch.start()
+    self.addCleanup(exec_patch.stop)
+    self.addCleanup(sleep_patch.stop)
+
+  async def fake_exec(self, *args, **kwargs):
+    self.calls.append((args, kwargs))
+    src_ref = args[4]
+    returncodes = self.returncodes.get(src_ref, [0])
+    returncode = returncodes.pop(0) if len(returncodes) > 1 else returncodes[0]
+    return FakeProcess(returncode, b"error for " + src_ref.encode() + b"\n", self.delays.get(src_ref, 0))
+
+  def add_tags(self, tag_requests):
+    asyncio.run(release.add_tags_async(tag_requests))
+
+  def test_one_invocation_per_request(self):
+    with mock.patch.dict(os.environ, {"CLOUDSDK_CORE_PROJECT": "set-after-import"}):
+      self.add_tags([("src:1", ["dst:a", "dst:b"]), ("src:2", [])])
+    self.assertEqual(len(self.calls), 1)
+    args, kwargs = self.calls[0]
+    self.assertEqual(args, ("gcloud", "container", "images", "add-tag", "src:1", "dst:a", "dst:b", "-q"))
+    self.assertEqual(kwargs["env"]["CLOUDSDK_COMPONENT_MANAGER_DISABLE_UPDATE_CHECK"], "1")
+    self.assertEqual(kwargs["env"]["CLOUDSDK_CORE_PROJECT"], "set-after-import")
+
+  def test_retries_with_backoff(self):
+    self.returncodes["src:1"] = [1, 1, 0]
+    self.add_tags([("src:1", ["dst:a"])])
+    self.assertEqual(len(self.calls), 3)
+    self.assertEqual([call.args[0] for call in self.sleep.await_args_list],
+                     [release._ADD_TAG_BACKOFF_SECONDS, release._ADD_TAG_BACKOFF_SECONDS * 2])
+
+  def test_raises_after_last_attempt(self):
+    self.returncodes["src:1"] = [1]
+    with self.assertRaisesRegex(Exception, "failed to tag src:1 as dst:a dst:b: error for src:1"):
+      self.add_tags([("src:1", ["dst:a", "dst:b"])])
+    self.assertEqual(len(self.calls), release._ADD_TAG_ATTEMPTS)
+
+  def test_reports_all_failures_after_in_flight_calls_finish(self):
+    self.returncodes["src:1"] = [1]
+    self.returncodes["src:2"] = [1]
+    self.delays["src:3"] = 0.01
+    with self.assertRaises(Exception) as context:
+      self.add_tags([("src:1", ["dst:a"]), ("src:2", ["dst:b"]), ("src:3", ["dst:c"])])
+    message = str(context.exception)
+    self.assertIn("2 of 3 add-tag calls failed", message)
+    self.assertIn("error for src:1", message)
+    self.assertIn("error for src:2", message)
+    self.assertEqual(len([call for call in self.calls if call[0][4] == "src:3"]), 1)
+
+class TestMain(unittest.TestCase):
+
+  def run_main(self, *args):
+    with mock.patch.object(sys, "argv", ["release.py", *args]), \
+         mock.patch.object(release, "verify_and_release") as verify_and_release:
+      release.main()
+    return verify_and_release.call_args.args
+
+  def test_verify(self):
+    self.assertEqual(self.run_main("--verify"), ("", "", False, False))
+
+  def test_verify_with_json_cache(self):
+    self.assertEqual(self.run_main("--write-json-cache", "--verify"), ("", "", False, True))
+
+  def test_release(self):
+    self.assertEqual(self.run_main("gcr.io/src", "dst1^dst2"), ("gcr.io/src", "dst1^dst2", True, False))
+
+  def test_release_with_json_cache(self):
+    self.assertEqual(self.run_main("gcr.io/src", "--write-json-cache", "dst"), ("gcr.io/src", "dst", True, True))
+
+  def test_invalid_arguments(self):
+    for args in [(), ("--write-json-cache",), ("a", "b", "c")]:
+      with self.assertRaises(SystemExit):
+        self.run_main(*args)
+
+if __name__ == '__main__':
+  unittest.main()
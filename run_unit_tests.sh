@@ -20,17 +20,14 @@ set -o pipefail
 usage() {
   cat <<'EOF'
 Usage: ./run_unit_tests.sh
-run_unit_tests.sh runs all unit tests under src/pkg and src/cmd in the cos/tools
-repository.
+run_unit_tests.sh runs all unit tests under src/pkg, src/cmd and release in the
+cos/tools repository.
 
 EOF
 }
 
 setup_test() {
-  # build changelogctl binary
-  go build -o src/cmd/changelogctl/changelogctl src/cmd/changelogctl/main.go
-
-  apt-get update && apt-get install -y sudo fdisk sysstat mtools dosfstools
+  apt-get update && apt-get install -y sudo fdisk sysstat mtools dosfstools python3 python3-yaml
 
   # clean up to save disk space
   rm -rf "$(readlink -f bazel-bin)"
@@ -64,6 +61,12 @@ main() {
       fi
     fi
   done
+
+  echo "Running tests for /workspace/release"
+  cd /workspace/release
+  if ! python3 -m unittest -v release_test; then
+    exit_code=1
+  fi
   return "${exit_code}"
 }
 
@@ -31,6 +31,7 @@ import (
 	"io/ioutil"
 	"net/http"
 	"os"
+	"path/filepath"
 	"time"
 
 	"cos.googlesource.com/cos/tools.git/src/pkg/changelog"
@@ -60,8 +61,8 @@ func getHTTPClient() (*http.Client, error) {
 	return oauth2.NewClient(oauth2.NoContext, creds.TokenSource), nil
 }
 
-func writeChangelogAsJSON(source string, target string, changes map[string]*changelog.RepoLog) error {
-	fileName := fmt.Sprintf("%s -> %s.json", source, target)
+func writeChangelogAsJSON(outputDir, source, target string, changes map[string]*changelog.RepoLog) error {
+	fileName := filepath.Join(outputDir, fmt.Sprintf("%s -> %s.json", source, target))
 	log.Infof("Writing changelog to %s\n", fileName)
 	jsonData, err := json.MarshalIndent(changes, "", "    ")
 	if err != nil {
@@ -73,7 +74,7 @@ func writeChangelogAsJSON(source string, target string, changes map[string]*chan
 	return nil
 }
 
-func generateChangelog(source, target, instance, manifestRepo string) error {
+func generateChangelog(source, target, instance, manifestRepo, outputDir string) error {
 	start := time.Now()
 	httpClient, err := getHTTPClient()
 	if err != nil {
@@ -84,11 +85,11 @@ func generateChangelog(source, target, instance, manifestRepo string) error {
 		return fmt.Errorf("generateChangelog: error retrieving changelog between builds %s and %s on GoB instance: %s with manifest repository: %s\n%v",
 			source, target, instance, manifestRepo, err)
 	}
-	if err := writeChangelogAsJSON(source, target, sourceToTargetChanges); err != nil {
+	if err := writeChangelogAsJSON(outputDir, source, target, sourceToTargetChanges); err != nil {
 		log.Errorf("generateChangelog: error writing first changelog with source: %s and target: %s\n%v\n",
 			source, target, err)
 	}
-	if err := writeChangelogAsJSON(target, source, targetToSourceChanges); err != nil {
+	if err := writeChangelogAsJSON(outputDir, target, source, targetToSourceChanges); err != nil {
 		log.Errorf("generateChangelog: Error writing second changelog with source: %s and target: %s\n%v\n",
 			target, source, err)
 	}
@@ -128,7 +129,7 @@ func getBuildForCL(gerrit, fallback, gob, manifestRepo, targetCL string) error {
 }
 
 func main() {
-	var mode, gobURL, gerritURL, fallbackURL, manifestRepo string
+	var mode, gobURL, gerritURL, fallbackURL, manifestRepo, outputDir string
 	var debug bool
 	app := &cli.App{
 		Name:  "changelogctl",
@@ -171,6 +172,13 @@ func main() {
 				Usage:       "`REPO` containing Manifest file",
 				Destination: &manifestRepo,
 			},
+			&cli.StringFlag{
+				Name:        "output-dir",
+				Value:       "",
+				Aliases:     []string{"o"},
+				Usage:       "`DIR` to write changelog files to",
+				Destination: &outputDir,
+			},
 			&cli.BoolFlag{
 				Name:        "debug",
 				Value:       false,
@@ -196,7 +204,7 @@ func main() {
 				}
 				source := c.Args().Get(0)
 				target := c.Args().Get(1)
-				return generateChangelog(source, target, gobURL, manifestRepo)
+				return generateChangelog(source, target, gobURL, manifestRepo, outputDir)
 			default:
 				return fmt.Errorf("please specify either \"findbuild\" or \"changelog\" mode")
 			}
@@ -17,11 +17,11 @@ package main
 import (
 	"bytes"
 	"encoding/json"
-	"errors"
 	"fmt"
 	"io/ioutil"
 	"os"
 	"os/exec"
+	"path/filepath"
 	"testing"
 )
 
@@ -34,7 +34,23 @@ const (
 
 var (
 	repoLogFields = []string{"Commits", "InstanceURL", "Repo", "SourceSHA", "TargetSHA", "HasMoreCommits"}
-	commitFields  = []string{"SHA", "AuthorName", "CommitterName", "Subject", "Bugs", "ReleaseNote", "CommitTime"}
+
+	// commitSchema pairs each commit field with a check on its decoded JSON value.
+	commitSchema = []struct {
+		field   string
+		isValid func(interface{}) bool
+	}{
+		{"SHA", isString},
+		{"AuthorName", isString},
+		{"CommitterName", isString},
+		{"Subject", isString},
+		{"Bugs", isListOrNull},
+		{"ReleaseNote", isString},
+		{"CommitTime", isString},
+	}
+
+	// binaryPath is the changelogctl binary TestMain builds for every test in the package.
+	binaryPath string
 )
 
 type Commit struct {
@@ -47,29 +63,40 @@ type Commit struct {
 	ReleaseNote   string
 }
 
-func setup() error {
-	// check if binary exists in the desired location.If not, compile from source.
-	_, err := os.Stat("changelogctl")
-	if errors.Is(err, os.ErrNotExist) {
-		cmd := exec.Command("go", "build", "-o", "changelogctl", "main.go")
-		return cmd.Run()
+// setup compiles main.go into a new temporary directory, so tests never run a
+// stale binary, and points binaryPath at the result. It returns the directory.
+func setup() (string, error) {
+	dir, err := os.MkdirTemp("", "changelogctl")
+	if err != nil {
+		return "", err
+	}
+	binaryPath = filepath.Join(dir, "changelogctl")
+	cmd := exec.Command("go", "build", "-o", binaryPath, "main.go")
+	if out, err := cmd.CombinedOutput(); err != nil {
+		os.RemoveAll(dir)
+		return "", fmt.Errorf("%v\n%s", err, out)
 	}
-	return err
+	return dir, nil
 }
 
-func cleanOutputFiles(source, target string) {
-	additions := filename(source, target)
-	removals := filename(target, source)
-	cmd := exec.Command("rm", additions, removals)
-	cmd.Run()
+// TestMain compiles the changelogctl binary once for all tests in the package.
+func TestMain(m *testing.M) {
+	dir, err := setup()
+	if err != nil {
+		fmt.Fprintf(os.Stderr, "Error compiling main.go:\n%v\n", err)
+		os.Exit(1)
+	}
+	code := m.Run()
+	os.RemoveAll(dir)
+	os.Exit(code)
 }
 
-func filename(source, target string) string {
-	return fmt.Sprintf("%s -> %s.json", source, target)
+func filename(dir, source, target string) string {
+	return filepath.Join(dir, fmt.Sprintf("%s -> %s.json", source, target))
 }
 
-func fileExists(source, target string) bool {
-	fname := filename(source, target)
+func fileExists(dir, source, target string) bool {
+	fname := filename(dir, source, target)
 	info, err := os.Stat(fname)
 	if os.IsNotExist(err) || info.IsDir() {
 		return false
@@ -77,25 +104,37 @@ func fileExists(source, target string) bool {
 	return true
 }
 
-func fileContents(source, target string) []byte {
-	fname := filename(source, target)
+func fileContents(dir, source, target string) []byte {
+	fname := filename(dir, source, target)
 	contents, _ := ioutil.ReadFile(fname)
 	return contents
 }
 
-func validateEmptyChangelog(source, target string) bool {
-	contents := fileContents(source, target)
+func validateEmptyChangelog(dir, source, target string) bool {
+	contents := fileContents(dir, source, target)
 	return string(contents) == "{}"
 }
 
+func isString(value interface{}) bool {
+	_, ok := value.(string)
+	return ok
+}
+
+// isListOrNull accepts null since nil slices are marshalled as null.
+func isListOrNull(value interface{}) bool {
+	_, ok := value.([]interface{})
+	return ok || value == nil
+}
+
 // validateCommit verifies if a given interface matches the commit format
 func validateCommit(input interface{}) bool {
 	commit, ok := input.(map[string]interface{})
 	if !ok {
 		return false
 	}
-	for _, field := range commitFields {
-		if _, ok := commit[field]; !ok {
+	for _, entry := range commitSchema {
+		value, ok := commit[entry.field]
+		if !ok || !entry.isValid(value) {
 			return false
 		}
 	}
@@ -127,33 +166,39 @@ func validateRepoLog(input interface{}) bool {
 	return true
 }
 
-func validateChangelogSchema(source, target string) bool {
-	if validateEmptyChangelog(source, target) {
-		return false
-	}
-	contents := fileContents(source, target)
-	var data interface{}
-	err := json.Unmarshal(contents, &data)
+// validateChangelogSchema verifies that a changelog file is a non-empty map of
+// valid repo logs. The file is decoded one repo log at a time so large
+// changelogs are never held in memory in full, and decoding stops at the first
+// invalid repo log.
+func validateChangelogSchema(dir, source, target string) bool {
+	f, err := os.Open(filename(dir, source, target))
 	if err != nil {
 		return false
 	}
-	if _, ok := data.(map[string]interface{}); !ok {
+	defer f.Close()
+	decoder := json.NewDecoder(f)
+	if tok, err := decoder.Token(); err != nil || tok != json.Delim('{') {
 		return false
 	}
-	for _, val := range data.(map[string]interface{}) {
-		if !validateRepoLog(val) {
+	repoLogs := 0
+	for decoder.More() {
+		// Skip the repository name key.
+		if _, err := decoder.Token(); err != nil {
+			return false
+		}
+		var repoLog interface{}
+		if err := decoder.Decode(&repoLog); err != nil || !validateRepoLog(repoLog) {
 			return false
 		}
+		repoLogs++
 	}
-	return true
+	if tok, err := decoder.Token(); err != nil || tok != json.Delim('}') {
+		return false
+	}
+	return repoLogs > 0
 }
 
 func TestChangelog(t *testing.T) {
-	err := setup()
-	if err != nil {
-		t.Fatalf("Error compiling main.go:\n%v", err)
-	}
-
 	tests := map[string]struct {
 		Source    string
 		Target    string
@@ -216,49 +261,46 @@ func TestChangelog(t *testing.T) {
 		},
 	}
 	for name, test := range tests {
+		test := test
 		t.Run(name, func(t *testing.T) {
-			args := append([]string{"-mode", "changelog"}, test.Args...)
+			t.Parallel()
+			dir := t.TempDir()
+			args := append([]string{"-mode", "changelog", "-output-dir", dir}, test.Args...)
 			args = append(args, []string{test.Source, test.Target}...)
-			cmd := exec.Command("./changelogctl", args...)
+			cmd := exec.Command(binaryPath, args...)
 			err := cmd.Run()
 			if test.ShouldErr {
 				switch {
 				case err == nil:
 					t.Fatalf("expected error, got nil")
-				case fileExists(test.Source, test.Target):
+				case fileExists(dir, test.Source, test.Target):
 					t.Fatalf("expected no files to be created, got additions file")
-				case fileExists(test.Target, test.Source):
+				case fileExists(dir, test.Target, test.Source):
 					t.Fatalf("expected no files to be created, got removals file")
 				}
 			} else {
 				switch {
 				case err != nil:
 					t.Fatalf("expected no error, got %v", err)
-				case !fileExists(test.Source, test.Target):
+				case !fileExists(dir, test.Source, test.Target):
 					t.Fatalf("expected additions file to be created, got no file")
-				case !fileExists(test.Target, test.Source):
+				case !fileExists(dir, test.Target, test.Source):
 					t.Fatalf("expected removals file to be created, got no file")
-				case test.EmptyAdds && !validateEmptyChangelog(test.Source, test.Target):
+				case test.EmptyAdds && !validateEmptyChangelog(dir, test.Source, test.Target):
 					t.Fatalf("expected empty additions file, got non-empty file")
-				case !test.EmptyAdds && !validateChangelogSchema(test.Source, test.Target):
+				case !test.EmptyAdds && !validateChangelogSchema(dir, test.Source, test.Target):
 					t.Fatalf("expected valid, nonempty additions file, got invalid/empty file")
-				case test.EmptyRms && !validateEmptyChangelog(test.Target, test.Source):
+				case test.EmptyRms && !validateEmptyChangelog(dir, test.Target, test.Source):
 					t.Fatalf("expected empty removals file, got non-empty file")
-				case !test.EmptyRms && !validateChangelogSchema(test.Target, test.Source):
+				case !test.EmptyRms && !validateChangelogSchema(dir, test.Target, test.Source):
 					t.Fatalf("expected valid, nonempty removals file, got invalid/empty file")
 				}
-				cleanOutputFiles(test.Source, test.Target)
 			}
 		})
 	}
 }
 
 func TestFindBuild(t *testing.T) {
-	err := setup()
-	if err != nil {
-		t.Fatalf("Error compiling main.go:\n%v", err)
-	}
-
 	tests := map[string]struct {
 		CL        string
 		Args      []string
@@ -303,11 +345,13 @@ func TestFindBuild(t *testing.T) {
 		},
 	}
 	for name, test := range tests {
+		test := test
 		t.Run(name, func(t *testing.T) {
+			t.Parallel()
 			var out bytes.Buffer
 			args := append([]string{"-mode", "findbuild"}, test.Args...)
 			args = append(args, test.CL)
-			cmd := exec.Command("./changelogctl", args...)
+			cmd := exec.Command(binaryPath, args...)
 			cmd.Stdout = &out
 			err := cmd.Run()
 			if test.ShouldErr && err == nil {